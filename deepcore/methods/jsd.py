@@ -37,7 +37,8 @@ class Jsd(CoresetMethod):
             # # Loading model state_dict
             # model.load_state_dict(checkpoint["state_dict"],strict=True)
 
-        model = nets.nets_utils.MyDataParallel(model).cuda()
+        if not self.args.distributed:
+            model = nets.nets_utils.MyDataParallel(model).cuda()
         model.eval()
         batch_loader = torch.utils.data.DataLoader(
             self.dst_train, batch_size=self.args.selection_batch, num_workers=self.args.workers,
@@ -1,4 +1,5 @@
 from torch.nn import DataParallel
+from torch.nn.parallel import DistributedDataParallel
 
 
 class MyDataParallel(DataParallel):
@@ -14,3 +15,18 @@ class MyDataParallel(DataParallel):
             return super().__setattr__(name, value)
         except AttributeError:
             return setattr(self.module, name, value)
+
+
+class MyDistributedDataParallel(DistributedDataParallel):
+    def __getattr__(self, name):
+        try:
+            return super().__getattr__(name)
+        except AttributeError:
+            return getattr(self.module, name)
+    def __setattr__(self, name, value):
+        try:
+            if name == "no_grad":
+                return setattr(self.module, name, value)
+            return super().__setattr__(name, value)
+        except AttributeError:
+            return setattr(self.module, name, value)
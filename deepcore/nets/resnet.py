@@ -15,14 +15,22 @@ class RseNet18(nn.Module):
         self.embedding_recorder = EmbeddingRecorder(record_embedding)
         self.decoder= nn.Linear(1000, 3)
         self.projection = nn.Linear(1000, 128)
+        self.use_projection = True
         
     def forward(self, x):
         features = self.encoder(x)
         features - self.embedding_recorder(features)
+        logits = self.decoder(features)
+        if not self.use_projection:
+            return logits,None
         projection = self.projection(features)
         projection = torch.nn.functional.normalize(projection, dim=1)  
-        logits = self.decoder(features)
         return logits,projection
+
+    def set_projection(self, enabled: bool):
+        # Frozen parameters are ignored by DistributedDataParallel, so an unused head does not stall reduction
+        self.use_projection = enabled
+        self.projection.requires_grad_(enabled)
     
 
     def get_last_layer(self):
@@ -2,6 +2,7 @@ import os
 import sys
 import torch.nn as nn
 import torch
+import torch.distributed as dist
 import argparse
 import deepcore.nets as nets
 import deepcore.datasets as datasets
@@ -15,31 +16,11 @@ import torchvision
 import logging
 import timeit
 
+# Expandable segments (torch>=2.1) avoid allocator cudaMalloc/cudaFree round-trips when buffer sizes vary.
+# The allocator reads this only once, so it must be set before CUDA is first used.
+if tuple(int(v) for v in torch.__version__.split('.')[:2]) >= (2, 1):
+    os.environ.setdefault('PYTORCH_CUDA_ALLOC_CONF', 'expandable_segments:True')
 
-class SupervisedContrastiveLoss(nn.Module):
-    def __init__(self, temperature=0.07):
-        super(SupervisedContrastiveLoss, self).__init__()
-        self.temperature = temperature
-
-    def forward(self, projections, labels):
-        device = projections.device
-        batch_size = projections.shape[0]
-        labels = labels.contiguous().view(-1, 1)
-        mask = torch.eq(labels, labels.T).float().to(device)
-
-        similarity_matrix = torch.matmul(projections, projections.T) / self.temperature
-
-
-        logits_max, _ = torch.max(similarity_matrix, dim=1, keepdim=True)
-        logits = similarity_matrix - logits_max.detach()
-
- 
-        exp_logits = torch.exp(logits) * (1 - torch.eye(batch_size).to(device))
-        log_prob = logits - torch.log(exp_logits.sum(1, keepdim=True))
-        mean_log_prob_pos = (mask * log_prob).sum(1) / mask.sum(1)
-
-        loss = -mean_log_prob_pos.mean()
-        return loss
 
 def main():
     parser = argparse.ArgumentParser(description='Parameter Processing')
@@ -60,6 +41,11 @@ def main():
                         help='number of data loading workers (default: 4)')
     parser.add_argument("--cross", type=str, nargs="+", default=None, help="models for cross-architecture experiments")
     parser.add_argument('--log', type=str, default='./logs/logs.txt', help='logging file')
+    parser.add_argument('--compile', default=False, type=str_to_bool,
+                        help="whether to compile the network with torch.compile (requires torch>=2.2)")
+    parser.add_argument('--compile_mode', type=str, default='max-autotune', help='mode passed to torch.compile')
+    parser.add_argument('--dist_backend', type=str, default='nccl',
+                        help='backend for distributed training when launched with torchrun (default: nccl)')
 
     # Optimizer and scheduler
     parser.add_argument('--optimizer', default="SGD", help='optimizer to use, e.g. SGD, Adam')
@@ -84,6 +70,10 @@ def main():
                      help="batch size for training, if not specified, it will equal to batch size in argument --batch")
     parser.add_argument("--selection_batch", "-sb", default=None, type=int,
                      help="batch size for selection, if not specified, it will equal to batch size in argument --batch")
+    parser.add_argument("--amp", default=False, type=str_to_bool,
+                        help="whether to run the forward pass and loss under bf16 autocast (default: False)")
+    parser.add_argument("--accum_steps", default=1, type=int,
+                        help="number of mini-batches to accumulate gradients over before each optimizer step (default: 1)")
 
     # Testing
     parser.add_argument("--test_interval", '-ti', default=1, type=int, help=
@@ -128,13 +118,17 @@ def main():
     parser.add_argument('--teacher', type=str, default=None, help='teacher model') 
 
     args = parser.parse_args()
+    if args.accum_steps < 1:
+        parser.error("--accum_steps must be at least 1")
     args.device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    init_distributed(args)
+    # Input shapes are fixed, so let cuDNN pick the fastest convolution algorithms
+    torch.backends.cudnn.benchmark = True
 
-    if not os.path.exists('logs'):
-        os.mkdir('logs')
+    os.makedirs('logs', exist_ok=True)
 
     log_format = '%(asctime)s %(message)s'
-    logging.basicConfig(stream=sys.stdout, level=logging.INFO,
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO if args.rank == 0 else logging.WARNING,
         format=log_format, datefmt='%m/%d %I:%M:%S %p')
     fh = logging.FileHandler(os.path.join(args.log))
     fh.setFormatter(logging.Formatter(log_format))
@@ -144,10 +138,9 @@ def main():
         args.train_batch = args.batch
     if args.selection_batch is None:
         args.selection_batch = args.batch
-    if args.save_path != "" and not os.path.exists(args.save_path):
-        os.mkdir(args.save_path)
-    if not os.path.exists(args.data_path):
-        os.mkdir(args.data_path)
+    if args.save_path != "":
+        os.makedirs(args.save_path, exist_ok=True)
+    os.makedirs(args.data_path, exist_ok=True)
 
     start_exp = 0
     for exp in range(start_exp, args.num_exp):
@@ -189,9 +182,16 @@ def main():
                 network = nets.__dict__[model]().to(args.device)
             else:
                 network = nets.__dict__[model](channel, num_classes, im_size).to(args.device)
+            # Only the logits are trained, keep the projection head out of the graph
+            if hasattr(network, 'set_projection'):
+                network.set_projection(False)
+            if args.compile:
+                network = compile_model(network, args.compile_mode)
 
             if args.device == "cpu":
                 logging.info("Using CPU.")
+            elif args.distributed:
+                network = nets.nets_utils.MyDistributedDataParallel(network, device_ids=[args.local_rank])
             elif args.gpu is not None:
                 torch.cuda.set_device(args.gpu[0])
                 network = nets.nets_utils.MyDataParallel(network, device_ids=args.gpu)
@@ -202,9 +202,7 @@ def main():
             train_loader, test_loader, if_weighted, subset, selection_args = load_subset(args, 0, dst_train, dst_test, mean, std, network)
 
             criterion = nn.CrossEntropyLoss(reduction='none').to(args.device)
-            criterion1 =SupervisedContrastiveLoss().to(args.device)
             
-            # criterion= criterion0+criterion1
             # Optimizer
             #if model == 'QResNet18':
             if args.bitwidth != None:
@@ -256,7 +254,7 @@ def main():
             best_prec1 = 0.0
 
             # Save the checkpont with only the susbet.
-            if args.save_path != "" and args.resume == "":
+            if args.save_path != "" and args.resume == "" and args.rank == 0:
                 save_checkpoint({"exp": exp,
                                  "subset": subset,
                                  "sel_args": selection_args},
@@ -271,12 +269,13 @@ def main():
             for epoch in range(start_epoch, args.epochs):
 
                 if epoch != 0 and epoch % args.data_update_epochs == 0 :
-                    print("Generating New Coreset")
+                    if args.rank == 0:
+                        print("Generating New Coreset")
                     train_loader, test_loader, if_weighted, subset, selection_args = load_subset(args, epoch, dst_train, dst_test, mean, std, network)
 
                 model_teacher=None
                 rec = init_recorder()
-                train(train_loader, network, criterion, criterion1,model_teacher, optimizer, scheduler, epoch, args, rec, if_weighted=if_weighted)
+                train(train_loader, network, criterion, model_teacher, optimizer, scheduler, epoch, args, rec, if_weighted=if_weighted)
 
                 # evaluate on validation set
                 if args.test_interval > 0 and (epoch + 1) % args.test_interval == 0:
@@ -287,7 +286,7 @@ def main():
 
                     if is_best:
                         best_prec1 = prec1
-                        if args.save_path != "":
+                        if args.save_path != "" and args.rank == 0:
                             rec = record_ckpt(rec, epoch)
                             save_checkpoint({"exp": exp,
                                              "epoch": epoch + 1,
@@ -302,7 +301,7 @@ def main():
                                             epoch=epoch, prec=best_prec1)
 
             # Prepare for the next checkpoint
-            if args.save_path != "":
+            if args.save_path != "" and args.rank == 0:
                 try:
                     os.rename(
                         os.path.join(args.save_path, checkpoint_name + ("" if model == args.model else model + "_") +
@@ -325,11 +324,15 @@ def main():
             logging.info('Best accuracy: {}'.format(best_prec1))
             end_time = timeit.default_timer()
             execution_time = end_time - start_time
-            print(f" {execution_time:.6f} s")
+            if args.rank == 0:
+                print(f" {execution_time:.6f} s")
             start_epoch = 0
             checkpoint = {}
             sleep(2)
 
+    if args.distributed:
+        dist.destroy_process_group()
+
 def load_subset(args, current_epoch, dst_train, dst_test, mean, std, current_model):
     selection_args = dict(epochs=args.selection_epochs,
                             selection_method=args.uncertainty,
@@ -337,11 +340,16 @@ def load_subset(args, current_epoch, dst_train, dst_test, mean, std, current_mod
                             greedy=args.submodular_greedy,
                             function=args.submodular
                             )
-    if args.selection == 'ACS':
-        method = methods.__dict__[args.selection](dst_train, args, current_epoch, current_model, args.fraction, args.seed, **selection_args)
-    else:
-        method = methods.__dict__[args.selection](dst_train, args, args.fraction, args.seed, **selection_args)
-    subset = method.select()
+    # Under DistributedDataParallel only rank 0 selects, so every rank trains on the same coreset
+    subset = None
+    if args.rank == 0:
+        if args.selection == 'ACS':
+            method = methods.__dict__[args.selection](dst_train, args, current_epoch, current_model, args.fraction, args.seed, **selection_args)
+        else:
+            method = methods.__dict__[args.selection](dst_train, args, args.fraction, args.seed, **selection_args)
+        subset = method.select()
+    if args.distributed:
+        subset = broadcast_object(subset)
     logging.info("The length for the subset:{}".format(len(subset["indices"])))
 
     # Augmentation
@@ -364,17 +372,20 @@ def load_subset(args, current_epoch, dst_train, dst_test, mean, std, current_mod
     else:
         dst_subset = torch.utils.data.Subset(dst_train, subset["indices"])
 
-    # BackgroundGenerator for ImageNet to speed up dataloaders
-    if args.dataset == "ImageNet":
-        train_loader = DataLoaderX(dst_subset, batch_size=args.train_batch, shuffle=True,
-                                    num_workers=args.workers, pin_memory=True)
-        test_loader = DataLoaderX(dst_test, batch_size=args.train_batch, shuffle=False,
-                                    num_workers=args.workers, pin_memory=True)
+    # Worker processes prefetch batches ahead of the training loop
+    loader_args = dict(batch_size=args.train_batch, num_workers=args.workers, pin_memory=True)
+    if args.workers > 0:
+        loader_args.update(persistent_workers=True, prefetch_factor=4)
+
+    # One shard of the data per process under DistributedDataParallel
+    if args.distributed:
+        train_sampler = torch.utils.data.distributed.DistributedSampler(dst_subset)
+        test_sampler = torch.utils.data.distributed.DistributedSampler(dst_test, shuffle=False)
+        train_loader = torch.utils.data.DataLoader(dst_subset, sampler=train_sampler, **loader_args)
+        test_loader = torch.utils.data.DataLoader(dst_test, sampler=test_sampler, **loader_args)
     else:
-        train_loader = torch.utils.data.DataLoader(dst_subset, batch_size=args.train_batch, shuffle=True,
-                                                    num_workers=args.workers, pin_memory=True)
-        test_loader = torch.utils.data.DataLoader(dst_test, batch_size=args.train_batch, shuffle=False,
-                                                    num_workers=args.workers, pin_memory=True)
+        train_loader = torch.utils.data.DataLoader(dst_subset, shuffle=True, **loader_args)
+        test_loader = torch.utils.data.DataLoader(dst_test, shuffle=False, **loader_args)
     return train_loader, test_loader, if_weighted, subset, selection_args
 
 
@@ -1,6 +1,8 @@
+import os
 import time, torch
+from contextlib import nullcontext
+import torch.distributed as dist
 from argparse import ArgumentTypeError
-from prefetch_generator import BackgroundGenerator
 import logging
 from sklearn.metrics import accuracy_score, average_precision_score, precision_score, f1_score, recall_score
 import numpy as np
@@ -15,110 +17,109 @@ def compute_confusion_matrix_elements(y_true, y_pred):
     :return: Dictionary with classes as keys and a sub-dictionary containing
              TP, TN, FP for each class.
     """
+    y_true = np.asarray(y_true)
+    y_pred = np.asarray(y_pred)
     classes = np.unique(np.concatenate((y_true, y_pred)))
-    metrics = {cls: {'TP': 0, 'TN': 0, 'FP': 0} for cls in classes}
-    
-    for true_label, pred_label in zip(y_true, y_pred):
-        for cls in classes:
-            if true_label == cls:
-                if pred_label == cls:
-                    metrics[cls]['TP'] += 1
-                # No need to increment FN explicitly as it's implied by absence of TP or FP
-            else:
-                if pred_label == cls:
-                    metrics[cls]['FP'] += 1
-                else:
-                    metrics[cls]['TN'] += 1
-                    
+    num_classes = len(classes)
+
+    # Map labels to dense indices and build the confusion matrix in one pass
+    true_idx = np.searchsorted(classes, y_true)
+    pred_idx = np.searchsorted(classes, y_pred)
+    cm = np.bincount(num_classes * true_idx + pred_idx,
+                     minlength=num_classes * num_classes).reshape(num_classes, num_classes)
+
+    tp = np.diag(cm)
+    fp = cm.sum(0) - tp
+    fn = cm.sum(1) - tp
+    # TN follows from the totals, no per-class counting needed
+    tn = len(y_true) - tp - fp - fn
+
+    metrics = {cls: {'TP': int(tp[c]), 'TN': int(tn[c]), 'FP': int(fp[c])} for c, cls in enumerate(classes)}
     return metrics
 
 class WeightedSubset(torch.utils.data.Subset):
     def __init__(self, dataset, indices, weights) -> None:
         self.dataset = dataset
         assert len(indices) == len(weights)
-        self.indices = indices
-        self.weights = weights
+        self.indices = np.asarray(indices, dtype=np.int64)
+        self.weights = torch.as_tensor(weights)
 
     def __getitem__(self, idx):
         if isinstance(idx, list):
-            return self.dataset[[self.indices[i] for i in idx]], self.weights[[i for i in idx]]
+            idx = np.asarray(idx, dtype=np.int64)
+            return self.dataset[self.indices[idx].tolist()], self.weights[torch.from_numpy(idx)]
         return self.dataset[self.indices[idx]], self.weights[idx]
 
-def evaluate_accuracy(data_iter, net, device):
-
-    acc_sum, n = 0.0, 0
-    true_labels = []
-    model_preds = []
-    with torch.no_grad():
-        net.eval()
-        for X, y in data_iter:
-            logits = net(X.to(device))[0]
-#             if isinstance(logits,tuple):
-#                 logits = logits[0]
-
-            model_pred = logits.argmax(dim=1)
-            true_label = y.to(device)
-
-            acc_sum += (model_pred == true_label).float().sum().cpu().item()
-
-            true_label = [int(item.float().cpu().item()) for item in true_label]
-            model_pred = [int(item.float().cpu().item()) for item in model_pred]
-            
-            true_labels+=true_label
-            model_preds+= model_pred
-            n += y.shape[0]
-        net.train()  # 改回训练模式
-    return acc_sum / n,true_labels,model_preds
-
-def train(train_loader, network, criterion, criterion1, model_teacher, optimizer, scheduler, epoch, args, rec, if_weighted: bool = False):
+def train(train_loader, network, criterion, model_teacher, optimizer, scheduler, epoch, args, rec, if_weighted: bool = False):
     """Train for one epoch on the training set"""
     batch_time = AverageMeter('Time', ':6.3f')
     losses = AverageMeter('Loss', ':.4e')
     top1 = AverageMeter('Acc@1', ':6.2f')
 
+    if isinstance(train_loader.sampler, torch.utils.data.distributed.DistributedSampler):
+        train_loader.sampler.set_epoch(epoch)
+
     # switch to train mode
     network.train()
     if model_teacher is not None:
         model_teacher.eval()
 
+    device = torch.device(args.device)
+    device_type = device.type
+    print_freq = args.print_freq
+    accum_steps = args.accum_steps
+    num_batches = len(train_loader)
+    # The last accumulation group of the epoch may hold fewer mini-batches
+    last_group_start = num_batches - (num_batches % accum_steps or accum_steps)
+    optimizer.zero_grad(set_to_none=True)
+
     end = time.time()
+    last_logged = 0
     for i, contents in enumerate(train_loader):
-        optimizer.zero_grad()
-        if if_weighted:
-            target = contents[0][1].to(args.device)
-            input = contents[0][0].to(args.device)
-
-            # Compute output
-            output = network(input)
-            weights = contents[1].to(args.device).requires_grad_(False)
-            loss = torch.sum(criterion(output, target) * weights) / torch.sum(weights)
-        else:
-            target = contents[1].to(args.device)
-            input = contents[0].to(args.device)
-
-            # Compute output
-            output,output2 = network(input)
-            if model_teacher is not None:
-                output_teacher = model_teacher(input)
-                loss = criterion(output, output_teacher)
-                losses.update(loss.item(), input.size(0))
+        # Run the forward pass and loss in bf16 when AMP is enabled
+        with torch.autocast(device_type=device_type, dtype=torch.bfloat16, enabled=args.amp):
+            if if_weighted:
+                target = contents[0][1].to(device, non_blocking=True)
+                input = contents[0][0].to(device, non_blocking=True)
+
+                # Compute output
+                output = network(input)[0]
+                weights = contents[1].to(device, non_blocking=True).requires_grad_(False)
+                loss = torch.sum(criterion(output, target) * weights) / torch.sum(weights)
             else:
-                loss = criterion(output, target).mean()+criterion1(output2,target)*0
-                losses.update(loss.data.item(), input.size(0))
+                target = contents[1].to(device, non_blocking=True)
+                input = contents[0].to(device, non_blocking=True)
+
+                # Compute output
+                output = network(input)[0]
+                if model_teacher is not None:
+                    output_teacher = model_teacher(input)
+                    loss = criterion(output, output_teacher)
+                    losses.update(loss, input.size(0))
+                else:
+                    loss = criterion(output, target).mean()
+                    losses.update(loss, input.size(0))
 
         # Measure accuracy and record loss
         prec1 = accuracy(output.data, target, topk=(1,))[0]
-        top1.update(prec1.item(), input.size(0))
-
-        # Compute gradient and do SGD step
-        loss.backward()
-        optimizer.step()
-
-        # Measure elapsed time
-        batch_time.update(time.time() - end)
-        end = time.time()
-
-        if i % args.print_freq == 0:
+        top1.update(prec1, input.size(0))
+
+        # Compute gradient and do SGD step once every accum_steps mini-batches
+        do_step = (i + 1) % accum_steps == 0 or i + 1 == num_batches
+        group_size = accum_steps if i < last_group_start else num_batches - last_group_start
+        # Skip the gradient all-reduce on micro-batches that do not step the optimizer
+        sync_context = network.no_sync() if not do_step and hasattr(network, 'no_sync') else nullcontext()
+        with sync_context:
+            (loss / group_size).backward()
+        if do_step:
+            optimizer.step()
+            optimizer.zero_grad(set_to_none=True)
+
+        if i % print_freq == 0:
+            # Measure elapsed time per batch since the last log line
+            now = time.time()
+            batch_time.update((now - end) / (i + 1 - last_logged), i + 1 - last_logged)
+            end, last_logged = now, i + 1
             logging.info('Epoch: [{0}][{1}/{2}]\t'
                   'Time {batch_time.val:.3f} ({batch_time.avg:.3f})\t'
                   'Loss {loss.val:.4f} ({loss.avg:.4f})\t'
@@ -140,28 +141,44 @@ def test(test_loader, network, criterion, epoch, args, rec):
     network.eval()
     network.no_grad = True
 
+    true_labels = []
+    model_preds = []
+    sample_losses = []
+    distributed = _is_distributed()
+    device = torch.device(args.device)
+    device_type = device.type
+    print_freq = args.print_freq
+
     end = time.time()
+    last_logged = 0
     for i, (input, target) in enumerate(test_loader):
-        target = target.to(args.device)
-        input = input.to(args.device)
+        target = target.to(device, non_blocking=True)
+        input = input.to(device, non_blocking=True)
 
         # Compute output
-        with torch.no_grad():
+        with torch.no_grad(), torch.autocast(device_type=device_type, dtype=torch.bfloat16, enabled=args.amp):
             output = network(input)[0]
             # print(output.shape)
 
-            loss = criterion(output, target).mean()
+            sample_loss = criterion(output, target)
+            loss = sample_loss.mean()
 
-        # Measure accuracy and record loss
-        prec1 = accuracy(output.data, target, topk=(1,))[0]
-        losses.update(loss.data.item(), input.size(0))
-        top1.update(prec1.item(), input.size(0))
-
-        # Measure elapsed time
-        batch_time.update(time.time() - end)
-        end = time.time()
+        pred = output.argmax(1).detach()
+        true_labels.append(target.detach())
+        model_preds.append(pred)
+        if distributed:
+            sample_losses.append(sample_loss.detach().float())
 
-        if i % args.print_freq == 0:
+        # Measure accuracy and record loss
+        prec1 = pred.eq(target).float().mean() * 100.0
+        losses.update(loss, input.size(0))
+        top1.update(prec1, input.size(0))
+
+        if i % print_freq == 0:
+            # Measure elapsed time per batch since the last log line
+            now = time.time()
+            batch_time.update((now - end) / (i + 1 - last_logged), i + 1 - last_logged)
+            end, last_logged = now, i + 1
             logging.info('Test: [{0}/{1}]\t'
                   'Time {batch_time.val:.3f} ({batch_time.avg:.3f})\t'
                   'Loss {loss.val:.4f} ({loss.avg:.4f})\t'
@@ -169,15 +186,31 @@ def test(test_loader, network, criterion, epoch, args, rec):
                 i, len(test_loader), batch_time=batch_time, loss=losses,
                 top1=top1))
 
+    true_labels = torch.cat(true_labels)
+    model_preds = torch.cat(model_preds)
+    if distributed:
+        # Each rank only saw its shard of the test set, recompute the statistics over the whole of it
+        num_samples = len(test_loader.dataset)
+        true_labels = _all_gather_unpadded(true_labels, num_samples)
+        model_preds = _all_gather_unpadded(model_preds, num_samples)
+        sample_losses = _all_gather_unpadded(torch.cat(sample_losses), num_samples)
+        losses.reset()
+        losses.update(sample_losses.mean(), num_samples)
+        top1.reset()
+        top1.update(model_preds.eq(true_labels).float().mean() * 100.0, num_samples)
+
     logging.info(' * Prec@1 {top1.avg:.3f}'.format(top1=top1))
-    test_acc,true_labels,model_preds = evaluate_accuracy(test_loader, network,args.device)
-    acc = round(accuracy_score(true_labels,model_preds),4)
-    pre = round(precision_score(true_labels,model_preds,average='macro'),4)
-    recall = round(recall_score(true_labels,model_preds,average='macro'),4)
-    f1 = round(f1_score(true_labels,model_preds,average='macro'),4)
-    spe = compute_confusion_matrix_elements(true_labels,model_preds)
-    print(acc,pre,recall,f1)
-    print(spe)
+    if args.rank == 0:
+        # Reuse the predictions from the loop above rather than a second forward pass
+        true_labels = true_labels.cpu().numpy()
+        model_preds = model_preds.cpu().numpy()
+        acc = round(accuracy_score(true_labels,model_preds),4)
+        pre = round(precision_score(true_labels,model_preds,average='macro'),4)
+        recall = round(recall_score(true_labels,model_preds,average='macro'),4)
+        f1 = round(f1_score(true_labels,model_preds,average='macro'),4)
+        spe = compute_confusion_matrix_elements(true_labels,model_preds)
+        print(acc,pre,recall,f1)
+        print(spe)
 
     network.no_grad = False
 
@@ -194,28 +227,64 @@ class AverageMeter(object):
         self.reset()
 
     def reset(self):
-        self.val = 0
-        self.avg = 0
-        self.sum = 0
+        self._val = 0
+        self._sum = 0
         self.count = 0
+        self._pending = []
 
     def update(self, val, n=1):
-        self.val = val
-        self.sum += val * n
+        # Tensors are kept on device and only synchronized when the statistics are read
+        if isinstance(val, torch.Tensor):
+            assert val.numel() == 1, "AverageMeter expects a one-element tensor"
+            self._pending.append((val.detach().reshape(()), n))
+        else:
+            self._flush()
+            self._val = val
+            self._sum += val * n
         self.count += n
-        self.avg = self.sum / self.count
+
+    def _flush(self):
+        if not self._pending:
+            return
+        vals = torch.stack([v for v, _ in self._pending])
+        ns = vals.new_tensor([n for _, n in self._pending])
+        # One device-to-host copy for all pending updates
+        total, last = torch.stack([(vals * ns).sum(), vals[-1]]).tolist()
+        self._sum += total
+        self._val = last
+        self._pending = []
+
+    @property
+    def val(self):
+        self._flush()
+        return self._val
+
+    @property
+    def sum(self):
+        self._flush()
+        return self._sum
+
+    @property
+    def avg(self):
+        return self.sum / self.count if self.count else 0
 
     def __str__(self):
         fmtstr = '{name} {val' + self.fmt + '} ({avg' + self.fmt + '})'
-        return fmtstr.format(**self.__dict__)
+        return fmtstr.format(name=self.name, val=self.val, avg=self.avg)
 
 
 def accuracy(output, target, topk=(1,)):
     """Computes the accuracy over the k top predictions for the specified values of k"""
     with torch.no_grad():
-        maxk = max(topk)
         batch_size = target.size(0)
 
+        # Top-1 only needs an argmax, not a sort
+        if tuple(topk) == (1,):
+            correct = output.argmax(dim=1).eq(target).float().sum(0, keepdim=True)
+            return [correct.mul_(100.0 / batch_size)]
+
+        maxk = max(topk)
+
         _, pred = output.topk(maxk, 1, True, True)
         pred = pred.t()
         correct = pred.eq(target.view(1, -1).expand_as(pred))
@@ -227,17 +296,65 @@ def accuracy(output, target, topk=(1,)):
         return res
 
 
+_TRUE_STRINGS = frozenset({'yes', 'true', 't', 'y', '1'})
+_FALSE_STRINGS = frozenset({'no', 'false', 'f', 'n', '0'})
+
+
 def str_to_bool(v):
     # Handle boolean type in arguments.
     if isinstance(v, bool):
         return v
-    if v.lower() in ('yes', 'true', 't', 'y', '1'):
+    v = v.lower()
+    if v in _TRUE_STRINGS:
         return True
-    elif v.lower() in ('no', 'false', 'f', 'n', '0'):
+    elif v in _FALSE_STRINGS:
         return False
     else:
         raise ArgumentTypeError('Boolean value expected.')
 
+def init_distributed(args):
+    """Initialize one process per GPU when launched with torchrun"""
+    args.distributed = int(os.environ.get('WORLD_SIZE', 1)) > 1
+    args.rank = 0
+    if not args.distributed:
+        return
+    args.local_rank = int(os.environ['LOCAL_RANK'])
+    if torch.cuda.is_available():
+        torch.cuda.set_device(args.local_rank)
+        args.device = 'cuda:%d' % args.local_rank
+    dist.init_process_group(backend=args.dist_backend)
+    args.rank = dist.get_rank()
+
+
+def compile_model(model, mode='max-autotune'):
+    """Compile the model in place so attribute access and state_dict keys are unchanged"""
+    if not hasattr(model, 'compile'):
+        logging.warning("torch.compile requires torch>=2.2, running the model eagerly.")
+        return model
+    model.compile(mode=mode)
+    return model
+
+
+def broadcast_object(obj, src=0):
+    """Send a picklable object from rank src to all other ranks"""
+    objects = [obj]
+    dist.broadcast_object_list(objects, src=src)
+    return objects[0]
+
+
+def _is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def _all_gather_unpadded(tensor, num_samples):
+    """Gather a per-sample tensor sharded by DistributedSampler(shuffle=False) back into dataset order"""
+    gathered = [torch.empty_like(tensor) for _ in range(dist.get_world_size())]
+    dist.all_gather(gathered, tensor)
+    # The sampler deals samples round-robin and pads the tail by wrapping around, so
+    # interleave the shards and drop the padding
+    return torch.stack(gathered, dim=1).reshape(-1)[:num_samples]
+
+
 def _get_learning_rate(optimizer):
     return max(param_group['lr'] for param_group in optimizer.param_groups)
 
@@ -279,7 +396,3 @@ def record_ckpt(rec, step):
     rec.ckpts.append(step)
     return rec
 
-
-class DataLoaderX(torch.utils.data.DataLoader):
-    def __iter__(self):
-        return BackgroundGenerator(super().__iter__())